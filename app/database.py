@@ -1,5 +1,7 @@
 from pathlib import Path
 
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base
 
@@ -9,11 +11,41 @@ DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 
 DATABASE_URL = f"sqlite+aiosqlite:///{DB_PATH}"
 
-engine = create_async_engine(DATABASE_URL, future=True)
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA busy_timeout=5000",
+)
+
+POOL_SIZE = 20
+MAX_OVERFLOW = 20
+
+engine = create_async_engine(DATABASE_URL, future=True, poolclass=AsyncAdaptedQueuePool, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW)
 AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 Base = declarative_base()
 
 
+if DATABASE_URL.startswith("sqlite"):
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        if ":memory:" not in DATABASE_URL:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+async def warm_pool() -> None:
+    conns = [await engine.connect() for _ in range(POOL_SIZE)]
+    for conn in conns:
+        await conn.close()
+
+
 async def get_db() -> AsyncSession:
     async with AsyncSessionLocal() as session:
         yield session
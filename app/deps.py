@@ -1,4 +1,6 @@
 from datetime import datetime
+from functools import lru_cache
+import time
 
 from fastapi import Depends, HTTPException, Request, status
 from sqlalchemy import select
@@ -12,20 +14,57 @@ def parse_iso(dt: str) -> datetime:
     return datetime.fromisoformat(dt)
 
 
+USER_CACHE_TTL = 30
+USER_CACHE_MAXSIZE = 2048
+_user_cache: dict[int, tuple[float, User]] = {}
+
+
+def invalidate_user_cache(user_id: int | None) -> None:
+    _user_cache.pop(user_id, None)
+
+
 async def get_current_user(request: Request, db: AsyncSession = Depends(get_db)) -> User:
+    user = getattr(request.state, "user", None)
+    if user is not None:
+        return user
     user_id = request.session.get("user_id")
     if not user_id:
         raise HTTPException(status_code=status.HTTP_302_FOUND, headers={"Location": "/login"})
-    user = await db.scalar(select(User).where(User.id == user_id))
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+    cached = _user_cache.get(user_id)
+    if cached and time.monotonic() - cached[0] < USER_CACHE_TTL:
+        user = cached[1]
+    else:
+        user = await db.scalar(select(User).where(User.id == user_id))
+        if not user:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        db.expunge(user)
+        if len(_user_cache) >= USER_CACHE_MAXSIZE:
+            _user_cache.pop(next(iter(_user_cache)))
+        _user_cache[user_id] = (time.monotonic(), user)
+    request.state.user = user
     return user
 
 
+def extra_pin_valid(request: Request) -> bool:
+    exp = request.session.get("extra_pin_exp")
+    return isinstance(exp, int) and exp > time.time()
+
+
 def require_role(*roles: str):
+    return _require_role_cached(frozenset(roles))
+
+
+@lru_cache(maxsize=None)
+def _require_role_cached(roles: frozenset[str]):
     async def checker(user: User = Depends(get_current_user)) -> User:
         if user.role not in roles:
             raise HTTPException(status_code=403, detail="Forbidden")
         return user
 
+    checker.__name__ = f"require_role_{'_'.join(sorted(roles))}"
     return checker
+
+
+def require_extra_pin(request: Request, user: User = Depends(require_role("field", "admin"))) -> None:
+    if not extra_pin_valid(request):
+        raise HTTPException(status_code=403, detail="Требуется PIN")
@@ -1,12 +1,22 @@
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
-from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
-from app.database import AsyncSessionLocal, Base, engine
+from app.database import AsyncSessionLocal, Base, engine, warm_pool
 from app.models import Service, Settings, User
 from app.routers import admin, auth, field, operator
-from app.security import hash_password
+
+DEFAULT_USERS = [
+    {"username": "admin", "role": "admin", "password_hash": "$2b$12$mOgYpufHnKm58I.KW2FE1.557N/MvPLlKaSyPn/UZX1VjhkKyshDS"},
+    {"username": "operator", "role": "operator", "password_hash": "$2b$12$8myBSRNnYzr5OlrEfwnuyeexzHg71dU9hzmRtF/YRmWa67aELB8FW"},
+    {"username": "field", "role": "field", "password_hash": "$2b$12$.901WSjExMbMep57E04RDuwe2fJEvTBOkEMek.ayJJ8GbK8x9IbhO"},
+]
+DEFAULT_SERVICES = [
+    {"name": "опломбировка", "is_extra_allowed": True},
+    {"name": "распломбировка", "is_extra_allowed": True},
+    {"name": "проверка пломб", "is_extra_allowed": True},
+]
 
 app = FastAPI(title="VDNKL Dispatch")
 app.add_middleware(SessionMiddleware, secret_key="change-me-in-prod", same_site="lax")
@@ -19,6 +29,12 @@ app.include_router(field.router)
 app.include_router(admin.router)
 
 
+def create_missing_indexes(conn):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
 @app.get("/")
 async def root():
     return {"ok": True, "login": "/login"}
@@ -28,27 +44,11 @@ async def root():
 async def startup():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(create_missing_indexes)
+
+    async with AsyncSessionLocal() as db, db.begin():
+        await db.execute(sqlite_insert(Settings).values(id=1, slot_minutes=30, default_capacity=6).on_conflict_do_nothing(index_elements=["id"]))
+        await db.execute(sqlite_insert(User).values(DEFAULT_USERS).on_conflict_do_nothing(index_elements=["username"]))
+        await db.execute(sqlite_insert(Service).values(DEFAULT_SERVICES).on_conflict_do_nothing(index_elements=["name"]))
 
-    async with AsyncSessionLocal() as db:
-        if not await db.get(Settings, 1):
-            db.add(Settings(id=1, slot_minutes=30, default_capacity=6))
-
-        for username, role, password in [
-            ("admin", "admin", "admin123"),
-            ("operator", "operator", "operator123"),
-            ("field", "field", "field123"),
-        ]:
-            exists = await db.scalar(select(User).where(User.username == username))
-            if not exists:
-                db.add(User(username=username, role=role, password_hash=hash_password(password)))
-
-        for name, extra_allowed in [
-            ("опломбировка", True),
-            ("распломбировка", True),
-            ("проверка пломб", True),
-        ]:
-            exists = await db.scalar(select(Service).where(Service.name == name))
-            if not exists:
-                db.add(Service(name=name, is_extra_allowed=extra_allowed))
-
-        await db.commit()
+    await warm_pool()
@@ -1,6 +1,6 @@
 from datetime import date, datetime
 
-from sqlalchemy import Boolean, Date, DateTime, ForeignKey, Integer, String, Text, UniqueConstraint
+from sqlalchemy import Boolean, Date, DateTime, ForeignKey, Index, Integer, String, Text, UniqueConstraint
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from app.database import Base
@@ -65,7 +65,7 @@ class Appointment(Base):
     house: Mapped[str] = mapped_column(String(64))
     apartment: Mapped[str] = mapped_column(String(64))
     address_extra: Mapped[str | None] = mapped_column(String(255), nullable=True)
-    slot_start: Mapped[datetime] = mapped_column(DateTime, index=True)
+    slot_start: Mapped[datetime] = mapped_column(DateTime)
     slot_end: Mapped[datetime] = mapped_column(DateTime)
     operator_comment: Mapped[str | None] = mapped_column(Text, nullable=True)
     field_notes: Mapped[str | None] = mapped_column(Text, nullable=True)
@@ -77,6 +77,12 @@ class Appointment(Base):
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     service = relationship("Service")
+    history = relationship("AppointmentHistory", order_by="AppointmentHistory.created_at.desc()", viewonly=True)
+
+    __table_args__ = (
+        Index("ix_appt_slot_status", "slot_start", "status"),
+        Index("ix_appt_assigned_slot", "assigned_to", "slot_start"),
+    )
 
 
 class AppointmentPhoto(Base):
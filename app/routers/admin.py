@@ -1,33 +1,57 @@
-from datetime import date, datetime, timedelta
-from io import BytesIO
+from datetime import date, datetime
+import os
+import tempfile
 
-from fastapi import APIRouter, Depends, Form, HTTPException, Query
-from fastapi.responses import RedirectResponse, StreamingResponse
-from fastapi.templating import Jinja2Templates
+from fastapi import APIRouter, Depends, Form, Query
+from fastapi.responses import FileResponse, RedirectResponse
 from fastapi import Request
-from openpyxl import Workbook
-from sqlalchemy import and_, func, select, update
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database import get_db
 from app.deps import require_role
-from app.models import Appointment, AppointmentPhoto, DaySetting, RescheduleRequest, Settings, SlotCapacity, User
-from app.security import hash_password
-from app.services import add_audit, add_history, get_settings, slot_end
-from app.utils import day_slots
+from app.models import Appointment, AppointmentPhoto, DaySetting, RescheduleRequest, Service, Settings, SlotCapacity, User
+from app.security import hash_pin
+from app.services import add_audit, add_history_and_audit, add_history_many, get_settings, invalidate_settings_cache, slot_end
+from app.templating import templates
+from app.utils import day_bounds, day_slots
 
 router = APIRouter(prefix="/admin", tags=["admin"])
-templates = Jinja2Templates(directory="app/templates")
+
+
+class TempFileResponse(FileResponse):
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            os.unlink(self.path)
+
+
+EXPORT_COLUMNS = (
+    Appointment.id,
+    Appointment.service_id,
+    Appointment.full_name,
+    Appointment.account_number,
+    Appointment.phone,
+    Appointment.street,
+    Appointment.house,
+    Appointment.apartment,
+    Appointment.slot_start,
+    Appointment.status,
+    Appointment.assigned_to,
+    Appointment.updated_at,
+)
 
 
 @router.get("/day-settings")
 async def day_settings_page(
     request: Request,
-    date_str: str | None = Query(None, alias="date"),
+    day: date | None = Query(None, alias="date"),
     db: AsyncSession = Depends(get_db),
     user: User = Depends(require_role("admin")),
 ):
-    day = date.fromisoformat(date_str) if date_str else date.today()
+    day = day or date.today()
     settings = await get_settings(db)
     ds = await db.get(DaySetting, day)
     slots = day_slots(day, settings.slot_minutes)
@@ -45,13 +69,9 @@ async def update_day_settings(
     user: User = Depends(require_role("admin")),
 ):
     d = date.fromisoformat(day)
-    ds = await db.get(DaySetting, d)
-    if not ds:
-        ds = DaySetting(date=d)
-        db.add(ds)
-    ds.self_assign_enabled = self_assign_enabled == "on"
-    ds.day_capacity_override = day_capacity_override
-    await add_audit(db, user.id, "day_settings", "day", str(d), f"self_assign={ds.self_assign_enabled}")
+    values = {"self_assign_enabled": self_assign_enabled == "on", "day_capacity_override": day_capacity_override}
+    await db.execute(sqlite_insert(DaySetting).values(date=d, **values).on_conflict_do_update(index_elements=["date"], set_=values))
+    await add_audit(db, user.id, "day_settings", "day", str(d), f"self_assign={values['self_assign_enabled']}")
     await db.commit()
     return RedirectResponse(f"/admin/day-settings?date={day}", status_code=303)
 
@@ -66,11 +86,11 @@ async def set_slot_capacity(
 ):
     d = date.fromisoformat(day)
     slot_dt = datetime.fromisoformat(slot_start)
-    existing = await db.scalar(select(SlotCapacity).where(and_(SlotCapacity.date == d, SlotCapacity.slot_start == slot_dt)))
-    if existing:
-        existing.capacity = capacity
-    else:
-        db.add(SlotCapacity(date=d, slot_start=slot_dt, capacity=capacity))
+    await db.execute(
+        sqlite_insert(SlotCapacity)
+        .values(date=d, slot_start=slot_dt, capacity=capacity)
+        .on_conflict_do_update(index_elements=["date", "slot_start"], set_={"capacity": capacity})
+    )
     await add_audit(db, user.id, "slot_capacity", "slot", slot_start, f"capacity={capacity}")
     await db.commit()
     return RedirectResponse(f"/admin/day-settings?date={day}", status_code=303)
@@ -78,7 +98,13 @@ async def set_slot_capacity(
 
 @router.get("/assign")
 async def assign_page(request: Request, db: AsyncSession = Depends(get_db), user: User = Depends(require_role("admin"))):
-    appointments = (await db.scalars(select(Appointment).where(Appointment.status.in_(["new", "accepted", "reschedule_pending"])).order_by(Appointment.slot_start))).all()
+    appointments = (
+        await db.execute(
+            select(Appointment.id, Appointment.full_name, Appointment.slot_start, Appointment.status, Appointment.street, Appointment.house)
+            .where(Appointment.status.in_(["new", "accepted", "reschedule_pending"]))
+            .order_by(Appointment.slot_start)
+        )
+    ).all()
     fields = (await db.scalars(select(User).where(User.role == "field"))).all()
     return templates.TemplateResponse("admin/assign.html", {"request": request, "appointments": appointments, "fields": fields})
 
@@ -90,9 +116,11 @@ async def mass_assign(
     db: AsyncSession = Depends(get_db),
     user: User = Depends(require_role("admin")),
 ):
-    for appt_id in appointment_ids:
-        await db.execute(update(Appointment).where(Appointment.id == appt_id).values(assigned_to=field_user_id, status="accepted"))
-        await add_history(db, appt_id, user.id, "assign", f"Назначен сотрудник {field_user_id}")
+    await db.execute(update(Appointment).where(Appointment.id.in_(appointment_ids)).values(assigned_to=field_user_id, status="accepted"))
+    await add_history_many(
+        db,
+        [{"appointment_id": appt_id, "user_id": user.id, "event_type": "assign", "description": f"Назначен сотрудник {field_user_id}"} for appt_id in appointment_ids],
+    )
     await add_audit(db, user.id, "mass_assign", "appointment", ",".join(map(str, appointment_ids)), f"field={field_user_id}")
     await db.commit()
     return RedirectResponse("/admin/assign", status_code=303)
@@ -105,46 +133,64 @@ async def approve_reschedule(
     db: AsyncSession = Depends(get_db),
     user: User = Depends(require_role("admin")),
 ):
-    req = await db.get(RescheduleRequest, request_id)
-    settings = await get_settings(db)
-    if req:
-        req.status = "approved"
+    appointment_id = await db.scalar(
+        update(RescheduleRequest).where(RescheduleRequest.id == request_id).values(status="approved").returning(RescheduleRequest.appointment_id)
+    )
+    if appointment_id:
+        settings = await get_settings(db)
         slot_start_dt = datetime.fromisoformat(new_slot)
         await db.execute(
             update(Appointment)
-            .where(Appointment.id == req.appointment_id)
+            .where(Appointment.id == appointment_id)
             .values(slot_start=slot_start_dt, slot_end=slot_end(slot_start_dt, settings.slot_minutes), assigned_to=None, status="new")
         )
-        await add_history(db, req.appointment_id, user.id, "reschedule_approved", f"Новый слот {new_slot}")
-        await add_audit(db, user.id, "reschedule_approved", "appointment", str(req.appointment_id), new_slot)
+        await add_history_and_audit(db, appointment_id, user.id, "reschedule_approved", f"Новый слот {new_slot}", new_slot)
         await db.commit()
     return RedirectResponse("/admin/assign", status_code=303)
 
 
 @router.get("/export")
 async def export_xlsx(
-    date_str: str = Query(..., alias="date"),
+    day: date = Query(..., alias="date"),
     db: AsyncSession = Depends(get_db),
     user: User = Depends(require_role("admin")),
 ):
-    day = date.fromisoformat(date_str)
-    start = datetime.combine(day, datetime.min.time())
-    end = datetime.combine(day + timedelta(days=1), datetime.min.time())
-    appointments = (await db.scalars(select(Appointment).where(Appointment.slot_start >= start, Appointment.slot_start < end))).all()
-
-    wb = Workbook()
-    ws = wb.active
+    start, end = day_bounds(day)
+    appointments = (await db.execute(select(*EXPORT_COLUMNS).where(Appointment.slot_start >= start, Appointment.slot_start < end))).all()
+    photo_counts = dict(
+        (
+            await db.execute(
+                select(AppointmentPhoto.appointment_id, func.count(AppointmentPhoto.id))
+                .where(AppointmentPhoto.appointment_id.in_([a.id for a in appointments]))
+                .group_by(AppointmentPhoto.appointment_id)
+            )
+        ).all()
+    )
+    service_names = dict((await db.execute(select(Service.id, Service.name))).all())
+    usernames = dict((await db.execute(select(User.id, User.username).where(User.id.in_({a.assigned_to for a in appointments if a.assigned_to})))).all())
+
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
     ws.append(["ID", "Услуга", "ФИО", "Л/С", "Телефон", "Адрес", "Слот", "Статус", "Исполнитель", "Изменено", "Фото"])
     for a in appointments:
-        photos_count = await db.scalar(select(func.count(AppointmentPhoto.id)).where(AppointmentPhoto.appointment_id == a.id))
-        ws.append([a.id, a.service_id, a.full_name, a.account_number, a.phone, f"{a.street} {a.house}-{a.apartment}", a.slot_start.isoformat(sep=" "), a.status, a.assigned_to or "", a.updated_at.isoformat(sep=" "), photos_count])
+        ws.append([a.id, service_names.get(a.service_id, ""), a.full_name, a.account_number, a.phone, f"{a.street} {a.house}-{a.apartment}", a.slot_start.isoformat(sep=" "), a.status, usernames.get(a.assigned_to, ""), a.updated_at.isoformat(sep=" "), photo_counts.get(a.id, 0)])
 
-    stream = BytesIO()
-    wb.save(stream)
-    stream.seek(0)
-    await add_audit(db, user.id, "export", "date", date_str, "xlsx export")
+    await add_audit(db, user.id, "export", "date", day.isoformat(), "xlsx export")
     await db.commit()
-    return StreamingResponse(stream, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers={"Content-Disposition": f"attachment; filename=appointments-{date_str}.xlsx"})
+    fd, tmp_path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        wb.save(tmp_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return TempFileResponse(
+        tmp_path,
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        filename=f"appointments-{day}.xlsx",
+    )
 
 
 @router.get("/settings")
@@ -161,13 +207,13 @@ async def update_settings(
     db: AsyncSession = Depends(get_db),
     user: User = Depends(require_role("admin")),
 ):
-    settings = await get_settings(db)
+    settings = await db.get(Settings, 1) or Settings(id=1)
     settings.slot_minutes = slot_minutes
     settings.default_capacity = default_capacity
     if pin.strip():
-        if len(pin.encode("utf-8")) > 72:
-            raise HTTPException(status_code=400, detail="PIN слишком длинный (bcrypt допускает до 72 байт)")
-        settings.field_extra_pin_hash = hash_password(pin)
+        settings.field_extra_pin_hash = hash_pin(pin)
+    db.add(settings)
     await add_audit(db, user.id, "settings", "settings", "1", "updated")
     await db.commit()
+    invalidate_settings_cache()
     return RedirectResponse("/admin/settings", status_code=303)
@@ -1,15 +1,15 @@
 from fastapi import APIRouter, Depends, Form, Request
 from fastapi.responses import RedirectResponse
-from fastapi.templating import Jinja2Templates
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database import get_db
+from app.deps import invalidate_user_cache
 from app.models import User
 from app.security import verify_password
+from app.templating import templates
 
 router = APIRouter()
-templates = Jinja2Templates(directory="app/templates")
 
 
 @router.get("/login")
@@ -33,5 +33,6 @@ async def login(request: Request, username: str = Form(...), password: str = For
 
 @router.get("/logout")
 async def logout(request: Request):
+    invalidate_user_cache(request.session.get("user_id"))
     request.session.clear()
     return RedirectResponse("/login", status_code=303)
@@ -2,36 +2,41 @@ from datetime import date, datetime
 
 from fastapi import APIRouter, Depends, Form, HTTPException, Query, Request
 from fastapi.responses import RedirectResponse
-from fastapi.templating import Jinja2Templates
 from sqlalchemy import and_, func, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 
 from app.database import get_db
 from app.deps import require_role
-from app.models import Appointment, AppointmentHistory, Service, User
-from app.services import add_audit, add_history, create_appointment_atomic, get_settings, slot_end
+from app.models import Appointment, User
+from app.services import add_history_and_audit, create_appointment_atomic, get_services, get_settings
+from app.templating import cached_template_response, templates
 from app.utils import day_slots
 
 router = APIRouter(prefix="/operator", tags=["operator"])
-templates = Jinja2Templates(directory="app/templates")
 
 
 @router.get("/schedule")
 async def schedule(
     request: Request,
-    date_str: str | None = Query(None, alias="date"),
+    day: date | None = Query(None, alias="date"),
     db: AsyncSession = Depends(get_db),
     user: User = Depends(require_role("operator", "admin")),
 ):
-    day = date.fromisoformat(date_str) if date_str else date.today()
+    day = day or date.today()
     settings = await get_settings(db)
-    slots = []
-    for slot in day_slots(day, settings.slot_minutes):
-        used = await db.scalar(
-            select(func.count(Appointment.id)).where(and_(Appointment.slot_start == slot, Appointment.status != "cancelled"))
-        )
-        slots.append({"slot": slot, "used": used or 0})
-    return templates.TemplateResponse("operator/schedule.html", {"request": request, "slots": slots, "day": day, "settings": settings})
+    day_slot_starts = day_slots(day, settings.slot_minutes)
+    counts = dict(
+        (
+            await db.execute(
+                select(Appointment.slot_start, func.count())
+                .where(and_(Appointment.slot_start.in_(day_slot_starts), Appointment.status != "cancelled"))
+                .group_by(Appointment.slot_start)
+            )
+        ).all()
+    )
+    slots = [{"slot": slot, "used": counts.get(slot, 0)} for slot in day_slot_starts]
+    return cached_template_response(request, "operator/schedule.html", {"request": request, "slots": slots, "day": day, "settings": settings}, user.id, day, settings.slot_minutes, settings.default_capacity, sorted(counts.items()))
 
 
 @router.get("/appointment/new")
@@ -41,7 +46,7 @@ async def new_appointment_form(
     db: AsyncSession = Depends(get_db),
     user: User = Depends(require_role("operator", "admin")),
 ):
-    services = (await db.scalars(select(Service).order_by(Service.name))).all()
+    services = await get_services(db)
     return templates.TemplateResponse("operator/new_appointment.html", {"request": request, "slot": slot, "services": services})
 
 
@@ -61,7 +66,6 @@ async def create_appointment(
     db: AsyncSession = Depends(get_db),
     user: User = Depends(require_role("operator", "admin")),
 ):
-    settings = await get_settings(db)
     slot_start = datetime.fromisoformat(slot)
     payload = {
         "service_id": service_id,
@@ -74,7 +78,6 @@ async def create_appointment(
         "apartment": apartment,
         "address_extra": address_extra or None,
         "slot_start": slot_start,
-        "slot_end": slot_end(slot_start, settings.slot_minutes),
         "operator_comment": operator_comment or None,
         "created_by": user.id,
     }
@@ -92,11 +95,10 @@ async def appointment_card(
     db: AsyncSession = Depends(get_db),
     user: User = Depends(require_role("operator", "admin")),
 ):
-    appointment = await db.get(Appointment, appointment_id)
+    appointment = (await db.scalars(select(Appointment).options(joinedload(Appointment.history)).where(Appointment.id == appointment_id))).unique().one_or_none()
     if not appointment:
         raise HTTPException(status_code=404)
-    history = (await db.scalars(select(AppointmentHistory).where(AppointmentHistory.appointment_id == appointment_id).order_by(AppointmentHistory.created_at.desc()))).all()
-    return templates.TemplateResponse("operator/appointment_card.html", {"request": request, "appointment": appointment, "history": history})
+    return cached_template_response(request, "operator/appointment_card.html", {"request": request, "appointment": appointment, "history": appointment.history}, user.id, appointment.id, appointment.updated_at, [h.id for h in appointment.history])
 
 
 @router.post("/appointment/{appointment_id}/cancel")
@@ -106,11 +108,11 @@ async def cancel_appointment(
     db: AsyncSession = Depends(get_db),
     user: User = Depends(require_role("operator", "admin")),
 ):
-    appt = await db.get(Appointment, appointment_id)
-    if not appt:
+    cancelled = await db.scalar(
+        update(Appointment).where(Appointment.id == appointment_id).values(status="cancelled", cancelled_reason=reason).returning(Appointment.id)
+    )
+    if not cancelled:
         raise HTTPException(status_code=404)
-    await db.execute(update(Appointment).where(Appointment.id == appointment_id).values(status="cancelled", cancelled_reason=reason))
-    await add_history(db, appointment_id, user.id, "cancel", f"Отменено: {reason}")
-    await add_audit(db, user.id, "cancel", "appointment", str(appointment_id), reason)
+    await add_history_and_audit(db, appointment_id, user.id, "cancel", f"Отменено: {reason}", reason)
     await db.commit()
     return RedirectResponse(f"/operator/appointment/{appointment_id}", status_code=303)
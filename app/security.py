@@ -1,3 +1,5 @@
+import hashlib
+import hmac
 import secrets
 from datetime import datetime, timedelta
 
@@ -14,6 +16,23 @@ def verify_password(password: str, password_hash: str) -> bool:
     return pwd_context.verify(password, password_hash)
 
 
+def hash_pin(pin: str) -> str:
+    key = secrets.token_hex(16)
+    return f"{key}${_pin_digest(key, pin)}"
+
+
+def verify_pin_hash(pin: str, pin_hash: str) -> bool:
+    if pin_hash.startswith("$2"):
+        # PINs saved before the switch to HMAC are bcrypt hashes.
+        return verify_password(pin, pin_hash)
+    key, _, digest = pin_hash.partition("$")
+    return hmac.compare_digest(_pin_digest(key, pin), digest)
+
+
+def _pin_digest(key: str, pin: str) -> str:
+    return hmac.new(key.encode("utf-8"), pin.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
 def make_token(expire_minutes: int = 10) -> dict:
     return {
         "value": secrets.token_urlsafe(16),
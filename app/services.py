@@ -1,6 +1,8 @@
 from datetime import date, datetime, timedelta
+import time
 
-from sqlalchemy import and_, func, select, text, update
+from sqlalchemy import and_, func, insert, literal, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.models import (
@@ -8,79 +10,105 @@ from app.models import (
     AppointmentHistory,
     AuditEvent,
     DaySetting,
+    Service,
     Settings,
     SlotCapacity,
 )
 
 
 async def add_history(db: AsyncSession, appointment_id: int, user_id: int | None, event_type: str, description: str):
-    db.add(AppointmentHistory(appointment_id=appointment_id, user_id=user_id, event_type=event_type, description=description))
+    await db.execute(insert(AppointmentHistory), {"appointment_id": appointment_id, "user_id": user_id, "event_type": event_type, "description": description})
+
+
+async def add_history_many(db: AsyncSession, rows: list[dict]):
+    if rows:
+        await db.execute(insert(AppointmentHistory), rows)
 
 
 async def add_audit(db: AsyncSession, user_id: int | None, event_type: str, entity_type: str, entity_id: str, details: str = ""):
-    db.add(AuditEvent(user_id=user_id, event_type=event_type, entity_type=entity_type, entity_id=entity_id, details=details))
+    await db.execute(insert(AuditEvent), {"user_id": user_id, "event_type": event_type, "entity_type": entity_type, "entity_id": entity_id, "details": details})
+
+
+async def add_history_and_audit(db: AsyncSession, appointment_id: int, user_id: int | None, event_type: str, description: str, details: str = ""):
+    await add_history(db, appointment_id, user_id, event_type, description)
+    await add_audit(db, user_id, event_type, "appointment", str(appointment_id), details)
+
+
+SETTINGS_CACHE_TTL = 30
+_settings_cache: tuple[float, Settings] | None = None
+
+
+def invalidate_settings_cache():
+    global _settings_cache
+    _settings_cache = None
 
 
 async def get_settings(db: AsyncSession) -> Settings:
+    global _settings_cache
+    if _settings_cache and time.monotonic() - _settings_cache[0] < SETTINGS_CACHE_TTL:
+        return _settings_cache[1]
     settings = await db.get(Settings, 1)
     if not settings:
-        settings = Settings(id=1, slot_minutes=30, default_capacity=6)
-        db.add(settings)
+        await db.execute(sqlite_insert(Settings).values(id=1, slot_minutes=30, default_capacity=6).on_conflict_do_nothing(index_elements=["id"]))
         await db.commit()
-        await db.refresh(settings)
+        settings = await db.get(Settings, 1)
+    db.expunge(settings)
+    _settings_cache = (time.monotonic(), settings)
     return settings
 
 
-async def capacity_for_slot(db: AsyncSession, slot_start: datetime) -> int:
-    settings = await get_settings(db)
+def capacity_expr(slot_start: datetime, default_capacity: int):
+    # Slot override wins, then a non-zero day override, then the global default.
     day = slot_start.date()
-    slot_specific = await db.scalar(select(SlotCapacity.capacity).where(and_(SlotCapacity.date == day, SlotCapacity.slot_start == slot_start)))
-    if slot_specific is not None:
-        return slot_specific
-    day_cap = await db.scalar(select(DaySetting.day_capacity_override).where(DaySetting.date == day))
-    if day_cap:
-        return day_cap
-    return settings.default_capacity
+    return func.coalesce(
+        select(SlotCapacity.capacity).where(and_(SlotCapacity.date == day, SlotCapacity.slot_start == slot_start)).scalar_subquery(),
+        func.nullif(select(DaySetting.day_capacity_override).where(DaySetting.date == day).scalar_subquery(), 0),
+        default_capacity,
+    )
+
+
+SERVICES_CACHE_TTL = 60
+_services_cache: tuple[float, list[dict]] | None = None
+
+
+async def get_services(db: AsyncSession) -> list[dict]:
+    global _services_cache
+    if _services_cache and time.monotonic() - _services_cache[0] < SERVICES_CACHE_TTL:
+        return _services_cache[1]
+    rows = (await db.execute(select(Service.id, Service.name, Service.is_extra_allowed).order_by(Service.name))).all()
+    services = [row._asdict() for row in rows]
+    _services_cache = (time.monotonic(), services)
+    return services
 
 
 async def create_appointment_atomic(db: AsyncSession, payload: dict):
     slot_start = payload["slot_start"]
-    slot_end = payload["slot_end"]
-    await db.execute(text("BEGIN IMMEDIATE"))
-    cap = await capacity_for_slot(db, slot_start)
-    current = await db.scalar(select(func.count(Appointment.id)).where(and_(Appointment.slot_start == slot_start, Appointment.status != "cancelled")))
-    if current >= cap:
+    settings = await get_settings(db)
+    end = slot_end(slot_start, settings.slot_minutes)
+    payload = {**payload, "slot_end": end}
+    used = select(func.count()).select_from(Appointment).where(and_(Appointment.slot_start == slot_start, Appointment.status != "cancelled")).scalar_subquery()
+    columns = Appointment.__table__.c
+    values = select(*(literal(value, columns[key].type) for key, value in payload.items())).where(used < capacity_expr(slot_start, settings.default_capacity))
+    appointment = await db.scalar(insert(Appointment).from_select(list(payload), values).returning(Appointment))
+    if appointment is None:
         await db.rollback()
         raise ValueError("Слот заполнен")
-    appointment = Appointment(**payload)
-    db.add(appointment)
-    await db.flush()
-    await add_history(db, appointment.id, payload["created_by"], "create", f"Создана заявка на слот {slot_start}")
-    await add_audit(db, payload["created_by"], "create", "appointment", str(appointment.id), f"slot={slot_start},end={slot_end}")
+    await add_history_and_audit(db, appointment.id, payload["created_by"], "create", f"Создана заявка на слот {slot_start}", f"slot={slot_start},end={end}")
     await db.commit()
-    await db.refresh(appointment)
     return appointment
 
 
 async def accept_self_assign_atomic(db: AsyncSession, appointment_id: int, field_user_id: int) -> bool:
-    appt = await db.get(Appointment, appointment_id)
-    if not appt:
-        return False
-    ds = await db.get(DaySetting, appt.slot_start.date())
-    if not ds or not ds.self_assign_enabled:
-        return False
-
-    await db.execute(text("BEGIN IMMEDIATE"))
+    self_assign_day = select(DaySetting.date).where(and_(DaySetting.date == func.date(Appointment.slot_start), DaySetting.self_assign_enabled.is_(True))).exists()
     result = await db.execute(
         update(Appointment)
-        .where(and_(Appointment.id == appointment_id, Appointment.status == "new", Appointment.assigned_to.is_(None)))
+        .where(and_(Appointment.id == appointment_id, Appointment.status == "new", Appointment.assigned_to.is_(None), self_assign_day))
         .values(status="accepted", assigned_to=field_user_id)
     )
     if result.rowcount != 1:
         await db.rollback()
         return False
-    await add_history(db, appointment_id, field_user_id, "accept", "Заявка принята выездным")
-    await add_audit(db, field_user_id, "accept", "appointment", str(appointment_id), "self-assign accepted")
+    await add_history_and_audit(db, appointment_id, field_user_id, "accept", "Заявка принята выездным", "self-assign accepted")
     await db.commit()
     return True
 
@@ -0,0 +1,26 @@
+import hashlib
+import os
+
+from fastapi import Request
+from fastapi.responses import Response
+from fastapi.templating import Jinja2Templates
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+IS_PRODUCTION = os.getenv("APP_ENV") == "production"
+
+env = Environment(
+    loader=FileSystemLoader("app/templates"),
+    autoescape=True,
+    auto_reload=not IS_PRODUCTION,
+    cache_size=400,
+    bytecode_cache=FileSystemBytecodeCache(),
+)
+templates = Jinja2Templates(env=env)
+
+
+def cached_template_response(request: Request, name: str, context: dict, *etag_parts) -> Response:
+    etag = '"' + hashlib.sha1(repr(etag_parts).encode()).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return templates.TemplateResponse(name, context, headers=headers)
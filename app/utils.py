@@ -1,27 +1,39 @@
 from datetime import date, datetime, time, timedelta
+from functools import lru_cache
 from pathlib import Path
+import shutil
+from typing import BinaryIO
 import uuid
 
 WINDOWS = [(time(8, 0), time(12, 0)), (time(13, 0), time(16, 0))]
 
 
-def day_slots(day: date, slot_minutes: int):
+@lru_cache(maxsize=512)
+def day_slots(day: date, slot_minutes: int) -> tuple[datetime, ...]:
     result = []
     for start_t, end_t in WINDOWS:
-        cur = datetime.combine(day, start_t)
-        end = datetime.combine(day, end_t)
-        while cur < end:
-            result.append(cur)
-            cur += timedelta(minutes=slot_minutes)
-    return result
+        start = datetime.combine(day, start_t)
+        span = (end_t.hour - start_t.hour) * 60 + end_t.minute - start_t.minute
+        result.extend(start + timedelta(minutes=offset) for offset in range(0, span, slot_minutes))
+    return tuple(result)
 
 
-def save_upload(base_dir: Path, appointment_id: int, filename: str, content: bytes) -> str:
+@lru_cache(maxsize=1024)
+def day_bounds(day: date) -> tuple[datetime, datetime]:
+    start = datetime(day.year, day.month, day.day)
+    return start, start + timedelta(days=1)
+
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def save_upload(base_dir: Path, appointment_id: int, filename: str, source: BinaryIO) -> str:
     ext = Path(filename).suffix or ".bin"
     rel = Path("uploads") / str(appointment_id)
     full = base_dir / rel
     full.mkdir(parents=True, exist_ok=True)
     unique = f"{uuid.uuid4().hex}{ext}"
     target = full / unique
-    target.write_bytes(content)
+    with target.open("wb") as out:
+        shutil.copyfileobj(source, out, UPLOAD_CHUNK_SIZE)
     return str(rel / unique)